@@ -1,18 +1,36 @@
 from __future__ import annotations
 
 import asyncio
+import hashlib
+import json
 import logging
+import string
 from typing import List, Optional
 
 import discord
 from discord import app_commands
 from storage import (
+    delete_command_hash,
+    get_command_hashes,
     get_genie_channel_id,
+    set_command_hash,
     set_genie_channel_id,
 )
 
 logger = logging.getLogger(__name__)
 
+_DEFAULT_THREAD_NAME_TEMPLATE = "genie-{author}-{id}"
+_THREAD_NAME_FIELDS = frozenset({"author", "id", "channel", "user_id"})
+
+
+def _validate_thread_name_template(template: str) -> None:
+    # Raises ValueError for malformed templates or placeholders we don't provide
+    for _literal, field, spec, _conversion in string.Formatter().parse(template):
+        if field is not None and field not in _THREAD_NAME_FIELDS:
+            raise ValueError(f"Unsupported placeholder {{{field}}} in thread name template")
+        if spec and "{" in spec:
+            raise ValueError("Nested placeholders are not supported in thread name template")
+
 
 class DiscordBot(discord.Client):
     def __init__(
@@ -21,7 +39,7 @@ class DiscordBot(discord.Client):
         allowed_channel_ids: List[int],
         system_prompt: str,
         llm_client,
-        thread_name_template: str = "genie-{author}-{id}",
+        thread_name_template: str = _DEFAULT_THREAD_NAME_TEMPLATE,
     ) -> None:
         intents = discord.Intents.default()
         intents.message_content = True  # Requires enabling in Discord Developer Portal
@@ -31,12 +49,35 @@ class DiscordBot(discord.Client):
         # Load persisted genie channel if available; otherwise use env-provided list
         persisted_genie = get_genie_channel_id()
         if persisted_genie:
-            self.allowed_channel_ids = {persisted_genie}
+            self._set_allowed_channels(frozenset((persisted_genie,)))
         else:
-            self.allowed_channel_ids = set(allowed_channel_ids or [])
+            self._set_allowed_channels(frozenset(allowed_channel_ids or ()))
         self.system_prompt = system_prompt
         self.llm = llm_client
+        self._stale_conversations_released = False
+        self._stale_conversations_done = False
+        self._guild_commands: List[app_commands.Command] = []
         self.thread_name_template = thread_name_template
+        # Reject bad templates at startup rather than failing on every message
+        try:
+            _validate_thread_name_template(thread_name_template)
+        except ValueError as e:
+            logger.warning("Invalid THREAD_NAME_TEMPLATE %r (%s); using default", thread_name_template, e)
+            self.thread_name_template = _DEFAULT_THREAD_NAME_TEMPLATE
+
+    def _set_allowed_channels(self, channel_ids: frozenset) -> None:
+        # Specialize the per-message channel check once, rather than re-deciding each time
+        self.allowed_channel_ids = channel_ids
+        if not channel_ids:
+            self._is_allowed = lambda message: True
+            return
+
+        def _is_allowed(message: discord.Message) -> bool:
+            channel = message.channel
+            # Threads are allowed via their parent channel; other channels have no parent_id
+            return channel.id in channel_ids or getattr(channel, "parent_id", None) in channel_ids
+
+        self._is_allowed = _is_allowed
 
     def _format_thread_name(self, message: discord.Message) -> str:
         # Build from template; allow placeholders: {author}, {id}, {channel}, {user_id}
@@ -60,18 +101,71 @@ class DiscordBot(discord.Client):
 
     async def on_ready(self):
         logger.info("Logged in as %s (ID: %s)", self.user, getattr(self.user, "id", "?"))
-        # Sync slash commands (global and per guild for immediate availability)
-        try:
-            await self.tree.sync()
-        except Exception:
-            pass
-        for g in list(getattr(self, "guilds", [])):
+        # Only on the first ready; later ones are reconnects with conversations in flight
+        if not self._stale_conversations_released:
+            self._stale_conversations_released = True
+            self._stale_conversations_done = self._release_stale_conversations()
+        # Sync slash commands per guild (immediately available, unlike global commands),
+        # skipping guilds whose synced commands already match the current definitions
+        synced = get_command_hashes()
+        all_guilds = list(getattr(self, "guilds", []))
+        for g in all_guilds:
+            # Needed locally to dispatch interactions, even where no sync is required
+            self._install_guild_commands(g)
+        guilds = [g for g in all_guilds if synced.get(str(g.id)) != self._guild_sync_token(g)]
+        sem = asyncio.Semaphore(10)  # stay well inside Discord's rate limits
+
+        async def sync_guild(g: discord.Guild):
+            async with sem:
+                await self._sync_guild(g)
+
+        results = await asyncio.gather(*(sync_guild(g) for g in guilds), return_exceptions=True)
+        for g, result in zip(guilds, results):
+            if isinstance(result, Exception):
+                logger.warning("Could not sync commands for guild %s: %s", g.id, result)
+
+        # The global set is empty; syncing it once clears registrations left by older
+        # versions, which would otherwise show every command twice
+        global_hash = self._commands_hash(self.tree.get_commands())
+        if synced.get("global") != global_hash:
             try:
-                await self.tree.sync(guild=g)
-            except Exception:
-                continue
+                await self.tree.sync()
+                set_command_hash("global", global_hash)
+            except Exception as e:
+                logger.warning("Could not sync global commands: %s", e)
         # No legacy guidelines-channel loading
 
+    def _commands_hash(self, commands: List[app_commands.Command]) -> str:
+        payload = [c.to_dict(self.tree) for c in commands]
+        return hashlib.blake2b(
+            json.dumps(payload, sort_keys=True, default=str).encode("utf-8"), digest_size=16
+        ).hexdigest()
+
+    def _guild_sync_token(self, guild: discord.Guild) -> str:
+        # Discord drops guild commands when the bot leaves, so a re-join (even while we
+        # were offline) must not match the token stored for the previous membership
+        joined_at = getattr(guild.me, "joined_at", None)
+        return self._commands_hash(self._guild_commands) + ":" + (joined_at.isoformat() if joined_at else "")
+
+    def _install_guild_commands(self, guild: discord.Guild) -> None:
+        for command in self._guild_commands:
+            self.tree.add_command(command, guild=guild, override=True)
+
+    async def _sync_guild(self, guild: discord.Guild) -> None:
+        self._install_guild_commands(guild)
+        await self.tree.sync(guild=guild)
+        set_command_hash(str(guild.id), self._guild_sync_token(guild))
+
+    async def on_guild_join(self, guild: discord.Guild):
+        try:
+            await self._sync_guild(guild)
+        except Exception as e:
+            logger.warning("Could not sync commands for guild %s: %s", guild.id, e)
+
+    async def on_guild_remove(self, guild: discord.Guild):
+        # Discord drops our guild commands; make sure a later re-join syncs them again
+        delete_command_hash(str(guild.id))
+
     async def setup_hook(self) -> None:  # type: ignore[override]
         # Define slash commands
 
@@ -83,14 +177,14 @@ class DiscordBot(discord.Client):
             if not member or not member.guild_permissions.administrator:
                 await interaction.response.send_message("Admin only.", ephemeral=True)
                 return
-            self.allowed_channel_ids = {channel.id}
+            self._set_allowed_channels(frozenset((channel.id,)))
             set_genie_channel_id(channel.id)
             await interaction.response.send_message(
                 f"Genie channel set to #{channel.name}.", ephemeral=True
             )
 
-        # Register commands
-        self.tree.add_command(genie_channel_cmd)
+        # Register commands per guild (see _sync_guild); the global set stays empty
+        self._guild_commands = [genie_channel_cmd]
         # Removed legacy guidelines commands
 
     async def on_message(self, message: discord.Message):
@@ -105,19 +199,21 @@ class DiscordBot(discord.Client):
         # Legacy '!' admin commands removed in favor of slash commands
 
         # After admin commands, enforce allowed channels if configured
-        if self.allowed_channel_ids:
-            try:
-                parent_id = None
-                if isinstance(message.channel, discord.Thread):
-                    parent_id = getattr(message.channel, "parent_id", None)
-                allowed = (
-                    (message.channel.id in self.allowed_channel_ids)
-                    or (parent_id in self.allowed_channel_ids)
-                )
-                if not allowed:
-                    return
-            except Exception:
-                return
+        if not self._is_allowed(message):
+            return
+
+        # Each Discord thread is one Assistants conversation. A thread started from a message
+        # shares that message's id, so the key is known before the thread exists.
+        conversation_key: Optional[str] = None
+        if isinstance(message.channel, discord.Thread):
+            conversation_key = str(message.channel.id)
+        elif isinstance(message.channel, discord.TextChannel):
+            conversation_key = str(message.id)
+
+        # Start generating the reply right away so it overlaps with thread creation
+        reply_task = asyncio.create_task(
+            self._generate_reply(content, author=str(message.author), conversation_key=conversation_key)
+        )
 
         # Decide target: create a thread for this message if we're in a text channel;
         # if already in a thread, continue within it. Fallback to channel on errors.
@@ -148,13 +244,15 @@ class DiscordBot(discord.Client):
                 )
             except Exception as e:
                 logger.warning("Could not create PRIVATE thread for message %s: %s", message.id, e)
+                # Replying in the channel; there will be no follow-ups to keep context for
+                reply_task.add_done_callback(lambda _t: self.llm.forget_conversation(str(message.id)))
         elif isinstance(message.channel, discord.Thread):
             target_channel = message.channel
 
-        # Provide a typing indicator while we think
+        # Provide a typing indicator for whatever is left of the wait
         async with target_channel.typing():
             try:
-                reply = await self._generate_reply(content, author=str(message.author))
+                reply = await reply_task
             except Exception as e:
                 logger.exception("Error generating reply: %s", e)
                 reply = (
@@ -177,7 +275,39 @@ class DiscordBot(discord.Client):
         except Exception:
             logger.exception("Failed to send reply to Discord")
 
-    async def _generate_reply(self, user_text: str, *, author: str) -> str:
+    async def on_thread_update(self, before: discord.Thread, after: discord.Thread):
+        # Release the Assistants thread once its Discord thread archives
+        if after.archived and not before.archived:
+            self.llm.forget_conversation(str(after.id))
+
+    async def on_raw_thread_delete(self, payload: discord.RawThreadDeleteEvent):
+        # Raw so threads missing from the cache are released too
+        self.llm.forget_conversation(str(payload.thread_id))
+
+    def _release_stale_conversations(self) -> bool:
+        # Threads that archived or were deleted while we were offline never send us an
+        # event. Active threads are all cached after login, so anything else is stale;
+        # except while a guild is unavailable, since its threads aren't cached yet and an
+        # uncached key can't be traced to its guild. Returns False if keys were skipped.
+        complete = not any(g.unavailable for g in self.guilds)
+        for key in self.llm.known_conversations():
+            thread = self.get_channel(int(key)) if key.isdigit() else None
+            if isinstance(thread, discord.Thread):
+                if thread.archived:
+                    self.llm.forget_conversation(key)
+            elif complete:
+                self.llm.forget_conversation(key)
+        return complete
+
+    async def on_guild_available(self, guild: discord.Guild):
+        # Finish the startup cleanup that was deferred while guilds were unavailable
+        if self._stale_conversations_released and not self._stale_conversations_done:
+            if not any(g.unavailable for g in self.guilds):
+                self._stale_conversations_done = self._release_stale_conversations()
+
+    async def _generate_reply(
+        self, user_text: str, *, author: str, conversation_key: Optional[str] = None
+    ) -> str:
         messages = [
             {
                 "role": "user",
@@ -189,12 +319,18 @@ class DiscordBot(discord.Client):
                 ),
             }
         ]
-        text = await self._call_llm(messages)
+        text = await self._call_llm(messages, query=user_text, conversation_key=conversation_key)
         return text.strip() or "I couldn't produce a recommendation from the details provided."
 
-    async def _call_llm(self, messages: List[dict]) -> str:
-        # Small sleep helps ensure typing indicator is visible
-        await asyncio.sleep(0.1)
-        return await self.llm.complete(self.system_prompt, messages)
+    async def _call_llm(
+        self,
+        messages: List[dict],
+        *,
+        query: Optional[str] = None,
+        conversation_key: Optional[str] = None,
+    ) -> str:
+        return await self.llm.complete(
+            self.system_prompt, messages, query=query, conversation_key=conversation_key
+        )
 
     # Legacy guidelines loading removed
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import os
+import stat
 from dataclasses import dataclass
 from typing import List, Optional
 
@@ -9,8 +10,6 @@ from dotenv import load_dotenv
 # Simplified: just load .env from the current working directory
 load_dotenv()
 
-from pathlib import Path
-
 
 def _load_system_prompt_prefix() -> str:
     # The environment variable SYSTEM_PROMPT_PREFIX is authoritative for the prefix.
@@ -21,7 +20,7 @@ def _load_system_prompt_prefix() -> str:
         raise RuntimeError("SYSTEM_PROMPT_PREFIX must be set in the environment and non-empty")
 
     # Heuristic: only treat the env value as a filesystem path if it looks like one.
-    # Avoid calling Path.exists() on long or multiline strings (which can raise
+    # Avoid calling os.stat() on long or multiline strings (which can raise
     # OSError on some platforms when treated as filenames).
     looks_like_path = True
     if "\n" in raw or "\0" in raw:
@@ -31,17 +30,18 @@ def _load_system_prompt_prefix() -> str:
         looks_like_path = False
 
     if looks_like_path:
-        p = Path(raw)
         try:
-            if p.exists() and p.is_file():
-                try:
-                    return p.read_text(encoding="utf-8").strip()
-                except Exception:
-                    return raw
+            st = os.stat(raw)
         except OSError:
-            # If the filesystem call fails (e.g. "File name too long"), treat
-            # the value as literal prompt text instead of a path.
+            # Missing file, or the filesystem call fails (e.g. "File name too long"):
+            # treat the value as literal prompt text instead of a path.
             return raw
+        if stat.S_ISREG(st.st_mode):
+            try:
+                with open(raw, "rb") as f:
+                    return f.read().decode("utf-8").strip()
+            except Exception:
+                return raw
 
     # Otherwise treat the environment value as the literal prompt text
     return raw
@@ -32,7 +32,7 @@ async def main() -> None:
     # Use only the SYSTEM_PROMPT_PREFIX as the Assistant instructions base.
     system_prompt = settings.system_prompt_prefix
 
-    llm = LLMClient(api_key=settings.openai_api_key, model=settings.openai_model)
+    llm = await LLMClient.create(api_key=settings.openai_api_key, model=settings.openai_model)
 
     bot = DiscordBot(
         allowed_channel_ids=settings.allowed_channel_ids,
@@ -45,7 +45,15 @@ async def main() -> None:
 
 
 if __name__ == "__main__":
+    # Prefer the libuv-based event loop where it's available (not on Windows/PyPy)
     try:
-        asyncio.run(main())
+        import uvloop
+
+        run = uvloop.run
+    except ImportError:
+        run = asyncio.run
+
+    try:
+        run(main())
     except KeyboardInterrupt:
         print("Shutting down...")
@@ -1,12 +1,35 @@
 from __future__ import annotations
 
 import asyncio
-import time
+import hashlib
+import logging
 import os
-from typing import List, Optional
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+import httpx
+import numpy as np
+from openai import AsyncOpenAI, NotFoundError
+from storage import (
+    delete_openai_thread,
+    get_openai_thread,
+    get_openai_threads,
+    load_response_cache,
+    load_settings,
+    save_response_cache,
+    save_settings,
+    set_openai_thread,
+)
+
+logger = logging.getLogger(__name__)
 
-from openai import OpenAI
-from storage import load_settings, save_settings
+EMBEDDING_MODEL = "text-embedding-3-small"
+CACHE_MAX_ENTRIES = 512
+CACHE_TTL_SECONDS = 3600.0
+SEMANTIC_THRESHOLD = 0.92
+MAX_CONCURRENT_RUNS = 8
+CACHE_SAVE_DELAY_SECONDS = 5.0
 
 
 class LLMClient:
@@ -17,23 +40,70 @@ class LLMClient:
       instructions to keep per-request prompts small.
         - Assistant is always configured with the file_search tool enabled; you can manually
             attach files/vector stores to it in the OpenAI dashboard.
-    - For each user query, creates a fresh Assistants Thread, posts the user's message(s),
-      runs the Assistant, polls until completion, fetches the Assistant's latest reply, and
-      deletes the thread to avoid cluttering memory.
+    - For each user query, posts the user's message(s) to an Assistants Thread, streams a
+      run of the Assistant until completion, and reads the Assistant's final reply. When a
+      conversation_key is given, the Thread is kept and reused for later messages in that
+      conversation (mapping persisted in .geniebot.json under "openai_threads"); otherwise
+      a fresh Thread is used and deleted in the background.
+    - Replies are cached in two tiers: an exact-match tier keyed by the instructions and
+      question text (persisted to .geniebot-cache.json), and an in-memory
+      semantic tier that reuses a reply when a new question's embedding is close enough
+      to a recent one. Only the opening question of a conversation is cached; follow-ups
+      depend on the conversation so far.
+    - Identical questions already in flight share a single Assistant run, and at most
+      MAX_CONCURRENT_RUNS runs are in progress at once to stay clear of rate limits.
 
     The complete(system_prompt, messages) signature is preserved for compatibility with the
     existing bot. The provided system_prompt is ignored in favor of the Assistant's
     configured instructions.
+
+    Use ``await LLMClient.create(...)`` to construct a client with its Assistant ready.
     """
 
     def __init__(self, api_key: str, model: str) -> None:
-        self.client = OpenAI(api_key=api_key)
+        # Keep-alive pool with HTTP/2 so the several calls per reply share connections
+        http_client = httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+                retries=2,
+            ),
+            timeout=httpx.Timeout(60.0, connect=5.0),
+        )
+        self.client = AsyncOpenAI(api_key=api_key, http_client=http_client)
         self.model = model
+        self.assistant_id: Optional[str] = None
+        self.instructions = ""
+        # Strong references to fire-and-forget cleanup tasks so they aren't GC'd mid-flight
+        self._background: Set[asyncio.Task] = set()
+
+        # Exact tier: key -> (created_at, reply), oldest first
+        self._exact: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        # Semantic tier: (unit-norm embedding, query, reply, created_at), oldest first
+        self._semantic: List[Tuple[np.ndarray, str, str, float]] = []
+        self._sem_matrix: Optional[np.ndarray] = None
+        self._cache_save_pending = False
+        self._load_cache()
 
+        # Single-flight: cache key -> task producing the reply for that question
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._sem = asyncio.Semaphore(MAX_CONCURRENT_RUNS)
+        # One run at a time per conversation; a Thread rejects messages while a run is active
+        self._conv_locks: Dict[str, asyncio.Lock] = {}
+        # Serializes re-creating the Assistant if it was deleted on the OpenAI side
+        self._assistant_lock = asyncio.Lock()
+        # Pending background seeds per conversation, and those forgotten while pending
+        self._seeds: Dict[str, asyncio.Task] = {}
+        self._forgotten: Set[str] = set()
+
+    @classmethod
+    async def create(cls, api_key: str, model: str) -> "LLMClient":
+        self = cls(api_key=api_key, model=model)
         # Load or create the Assistant configured with prefix instructions
-        self.assistant_id = self._ensure_assistant()
+        self.assistant_id = await self._ensure_assistant()
+        return self
 
-    def _ensure_assistant(self) -> str:
+    async def _ensure_assistant(self) -> str:
         data = load_settings()  # uses .geniebot.json
         assistant_id = data.get("assistant_id")
 
@@ -41,19 +111,30 @@ class LLMClient:
         prefix = os.getenv("SYSTEM_PROMPT_PREFIX", "").strip()
         if not prefix:
             prefix = "You are an assistant."
+        self.instructions = prefix
 
     # Always enable file_search on the Assistant so you can attach/upload files manually
 
+        # Skip the update round-trip when model and instructions match what we last pushed
+        cfg_hash = hashlib.blake2b(
+            (self.model + "\x00" + prefix).encode("utf-8"), digest_size=16
+        ).hexdigest()
+        if assistant_id and data.get("assistant_cfg_hash") == cfg_hash:
+            return assistant_id
+
         # If we have an existing assistant, try to update its instructions/model and
         # ensure vector store linkage if a guidelines file is provided.
         if assistant_id:
             try:
-                updated = self.client.beta.assistants.update(
+                updated = await self.client.beta.assistants.update(
                     assistant_id=assistant_id,
                     model=self.model,
                     instructions=prefix,
                     tools=[{"type": "file_search"}],
                 )
+                data["assistant_id"] = updated.id
+                data["assistant_cfg_hash"] = cfg_hash
+                save_settings(data)
                 return updated.id
             except Exception:
                 # Fall through to create a new assistant if update fails
@@ -62,81 +143,359 @@ class LLMClient:
         # Create new assistant
         tools = [{"type": "file_search"}]
 
-        assistant = self.client.beta.assistants.create(
+        assistant = await self.client.beta.assistants.create(
             name="GenieBot Assistant",
             model=self.model,
             instructions=prefix,
             tools=tools,
         )
         data["assistant_id"] = assistant.id
+        data["assistant_cfg_hash"] = cfg_hash
         save_settings(data)
         return assistant.id
 
-    async def complete(self, system_prompt: str, messages: List[dict]) -> str:
-        # Build a fresh thread for this query so memory is isolated per conversation
-        def run_sync_flow(user_messages: List[dict]) -> str:
-            thread = self.client.beta.threads.create()
-
-            # Add user messages to the thread (we expect one user message; support many just in case)
-            for m in user_messages:
-                if m.get("role") == "user":
-                    content = m.get("content", "")
-                    if content:
-                        self.client.beta.threads.messages.create(
-                            thread_id=thread.id,
-                            role="user",
-                            content=content,
-                        )
-
-            # Start a run
-            run = self.client.beta.threads.runs.create(
-                thread_id=thread.id,
-                assistant_id=self.assistant_id,
-            )
-
-            # Poll until complete
-            while run.status in ("queued", "in_progress", "requires_action"):
-                time.sleep(0.5)
-                run = self.client.beta.threads.runs.retrieve(
-                    thread_id=thread.id,
-                    run_id=run.id,
-                )
+    async def _recover_assistant(self, failed_id: str) -> bool:
+        """Re-create the Assistant if ``failed_id`` (the one a failing run used) no longer exists.
 
-            # Fetch the latest assistant message
-            text = ""
+        Returns True when a usable Assistant is in place and the failed call can be retried.
+        """
+        async with self._assistant_lock:
+            if self.assistant_id != failed_id:
+                return True  # another caller already replaced it
             try:
-                msgs = self.client.beta.threads.messages.list(thread_id=thread.id, order="desc", limit=5)
-                for msg in msgs.data:
-                    if msg.role == "assistant":
-                        # message content array may contain text parts
-                        for part in msg.content:
-                            if getattr(part, "type", None) == "text":
-                                text = part.text.value
-                                break
-                        if text:
-                            break
-            except Exception:
+                await self.client.beta.assistants.retrieve(assistant_id=failed_id)
+                return False  # the Assistant exists; the 404 was about something else
+            except NotFoundError:
                 pass
+            except Exception:
+                return False
+            logger.warning("Assistant %s no longer exists; creating a new one", failed_id)
+            data = load_settings()
+            data.pop("assistant_id", None)
+            data.pop("assistant_cfg_hash", None)
+            save_settings(data)
+            self.assistant_id = await self._ensure_assistant()
+            return True
 
-            # Debug print of the assistant reply (length + snippet) for verification
+    def _load_cache(self) -> None:
+        # Older versions kept the cache inside the settings file; drop it from there
+        data = load_settings()
+        if data.pop("response_cache", None) is not None:
             try:
-                print(f"--- ASSISTANT REPLY (len={len(text)}) ---")
-                print(text)
-                print("--- END REPLY ---")
-            except Exception:
+                save_settings(data)
+            except RuntimeError:
                 pass
 
-            # Attempt to delete the thread to avoid clutter
+        now = time.time()
+        entries = []
+        for key, val in load_response_cache().items():
             try:
-                self.client.beta.threads.delete(thread_id=thread.id)
+                created_at, reply = float(val[0]), str(val[1])
             except Exception:
-                pass
+                continue
+            if now - created_at < CACHE_TTL_SECONDS:
+                entries.append((created_at, key, reply))
+        for created_at, key, reply in sorted(entries)[-CACHE_MAX_ENTRIES:]:
+            self._exact[key] = (created_at, reply)
+
+    def _schedule_cache_save(self) -> None:
+        # Debounce: a burst of new replies results in a single write
+        if self._cache_save_pending:
+            return
+        self._cache_save_pending = True
+        self._spawn(self._save_cache())
+
+    async def _save_cache(self) -> None:
+        await asyncio.sleep(CACHE_SAVE_DELAY_SECONDS)
+        self._cache_save_pending = False
+        snapshot = {k: [ts, reply] for k, (ts, reply) in self._exact.items()}
+        try:
+            # Serialize and write off the event loop; the file can be a few MB
+            await asyncio.to_thread(save_response_cache, snapshot)
+        except RuntimeError:
+            logger.warning("Could not save response cache", exc_info=True)
+
+    def _cache_key(self, query: str) -> str:
+        raw = self.model + "\x00" + self.instructions + "\x00" + query
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _exact_get(self, key: str) -> Optional[str]:
+        hit = self._exact.get(key)
+        if hit is None:
+            return None
+        if time.time() - hit[0] >= CACHE_TTL_SECONDS:
+            del self._exact[key]
+            return None
+        self._exact.move_to_end(key)
+        return hit[1]
+
+    async def _embed(self, text: str) -> Optional[np.ndarray]:
+        try:
+            resp = await self.client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+        except Exception:
+            return None
+        vec = np.asarray(resp.data[0].embedding, dtype=np.float32)
+        norm = float(np.linalg.norm(vec))
+        return vec / norm if norm else None
+
+    def _semantic_get(self, emb: np.ndarray) -> Optional[str]:
+        now = time.time()
+        live = [e for e in self._semantic if now - e[3] < CACHE_TTL_SECONDS]
+        if len(live) != len(self._semantic):
+            self._semantic = live
+            self._sem_matrix = None
+        if not self._semantic:
+            return None
+        if self._sem_matrix is None:
+            self._sem_matrix = np.stack([e[0] for e in self._semantic])
+        # Rows and query are unit-norm, so the dot product is the cosine similarity
+        sims = self._sem_matrix @ emb
+        best = int(np.argmax(sims))
+        if float(sims[best]) >= SEMANTIC_THRESHOLD:
+            return self._semantic[best][2]
+        return None
+
+    def _cache_put(self, key: str, query: str, reply: str, emb: Optional[np.ndarray]) -> None:
+        now = time.time()
+        self._exact[key] = (now, reply)
+        self._exact.move_to_end(key)
+        while len(self._exact) > CACHE_MAX_ENTRIES:
+            self._exact.popitem(last=False)
+        if emb is not None:
+            self._semantic.append((emb, query, reply, now))
+            if len(self._semantic) > CACHE_MAX_ENTRIES:
+                del self._semantic[: len(self._semantic) - CACHE_MAX_ENTRIES]
+            self._sem_matrix = None
+        self._schedule_cache_save()
+
+    def _spawn(self, coro) -> None:
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
 
-            return text or ""
+    async def _delete_thread(self, thread_id: str) -> None:
+        # Attempt to delete the thread to avoid clutter
+        try:
+            await self.client.beta.threads.delete(thread_id=thread_id)
+        except Exception:
+            pass
 
-    # Removed verbose instruction/user payload printing as requested
+    def _user_contents(self, messages: List[dict]) -> List[str]:
+        return [m.get("content", "") for m in messages if m.get("role") == "user" and m.get("content")]
+
+    def known_conversations(self) -> List[str]:
+        """Return the conversation keys that have a kept Thread and no call in progress."""
+        return [
+            key
+            for key in get_openai_threads()
+            if not (key in self._conv_locks and self._conv_locks[key].locked())
+        ]
+
+    def forget_conversation(self, conversation_key: str) -> None:
+        """Drop the Thread kept for ``conversation_key`` and delete it in the background."""
+        self._conv_locks.pop(conversation_key, None)
+        if conversation_key in self._seeds:
+            # The pending seed checks this and discards whatever it creates
+            self._forgotten.add(conversation_key)
+        thread_id = delete_openai_thread(conversation_key)
+        if thread_id:
+            self._spawn(self._delete_thread(thread_id))
+
+    async def _seed_conversation(self, conversation_key: str, messages: List[dict], reply: str) -> None:
+        # A cached or shared reply never touched a Thread of ours; create one holding the
+        # exchange so follow-ups in this conversation keep their context
+        lock = self._conv_locks.setdefault(conversation_key, asyncio.Lock())
+        try:
+            async with lock:
+                if conversation_key in self._forgotten or get_openai_thread(conversation_key):
+                    return
+                seed = [{"role": "user", "content": c} for c in self._user_contents(messages)]
+                seed.append({"role": "assistant", "content": reply})
+                try:
+                    thread = await self.client.beta.threads.create(messages=seed)
+                except Exception:
+                    logger.warning("Could not seed Assistants thread for %s", conversation_key, exc_info=True)
+                    return
+                if conversation_key in self._forgotten:
+                    # The conversation ended while we were creating its thread
+                    await self._delete_thread(thread.id)
+                    return
+                set_openai_thread(conversation_key, thread.id)
+        finally:
+            self._seeds.pop(conversation_key, None)
+            if conversation_key in self._forgotten:
+                self._forgotten.discard(conversation_key)
+                # A newer call for this key may have made a fresh lock; leave that one alone
+                if self._conv_locks.get(conversation_key) is lock:
+                    del self._conv_locks[conversation_key]
+
+    async def complete(
+        self,
+        system_prompt: str,
+        messages: List[dict],
+        *,
+        query: Optional[str] = None,
+        conversation_key: Optional[str] = None,
+    ) -> str:
+        """Return the Assistant's reply to ``messages``.
+
+        ``query`` is the bare question used for cache lookups; it defaults to the joined
+        user message contents. Pass it when the messages carry per-user decoration (such
+        as the author's name) that shouldn't prevent cache hits.
+
+        ``conversation_key`` identifies a conversation (e.g. a Discord thread id) whose
+        Assistants Thread should be kept and reused across calls.
+        """
+        if self.assistant_id is None:
+            self.assistant_id = await self._ensure_assistant()
+
+        if conversation_key is None:
+            text, _ = await self._complete_shared(query, messages, None)
+            return text
+
+        lock = self._conv_locks.setdefault(conversation_key, asyncio.Lock())
+        async with lock:
+            thread_id = get_openai_thread(conversation_key)
+            if thread_id:
+                # Follow-ups depend on the conversation so far; never cached or shared
+                try:
+                    async with self._sem:
+                        text, _ = await self._run_assistant(messages, thread_id=thread_id)
+                    return text
+                except NotFoundError:
+                    # The kept thread is gone upstream (deleted or purged); start a new one
+                    logger.warning(
+                        "Assistants thread %s for %s no longer exists; starting a new one",
+                        thread_id,
+                        conversation_key,
+                    )
+                    delete_openai_thread(conversation_key)
+
+            text, owned = await self._complete_shared(query, messages, conversation_key)
+        if text and not owned and conversation_key not in self._seeds:
+            # Registered before returning so a forget_conversation() right after sees it
+            task = asyncio.create_task(self._seed_conversation(conversation_key, messages, text))
+            self._seeds[conversation_key] = task
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+        return text
+
+    async def _complete_shared(
+        self, query: Optional[str], messages: List[dict], conversation_key: Optional[str]
+    ) -> Tuple[str, bool]:
+        # Returns (reply, whether a Thread was kept for conversation_key)
+        if query is None:
+            query = "\n\n".join(self._user_contents(messages))
+        query = query.strip()
+
+        key = self._cache_key(query)
+        cached = self._exact_get(key)
+        if cached is not None:
+            return cached, False
+
+        # Join an identical question that is already being answered, if any
+        task = self._inflight.get(key)
+        leader = task is None
+        if task is None:
+            task = asyncio.create_task(self._complete_uncached(key, query, messages, conversation_key))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, k=key: self._finish_inflight(k, t))
+        # Shield so one caller giving up doesn't cancel the run for everyone else
+        text, ran = await asyncio.shield(task)
+        return text, leader and ran and conversation_key is not None
+
+    def _finish_inflight(self, key: str, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # mark retrieved even if every waiter went away
+
+    async def _complete_uncached(
+        self, key: str, query: str, messages: List[dict], conversation_key: Optional[str]
+    ) -> Tuple[str, bool]:
+        # Returns (reply, whether the Assistant actually ran)
+        emb = await self._embed(query) if query else None
+        if emb is not None:
+            cached = self._semantic_get(emb)
+            if cached is not None:
+                return cached, False
+
+        async with self._sem:
+            text, status = await self._run_assistant(messages, keep_for=conversation_key)
+        # Partial text from an incomplete/cancelled/expired run must not be reused
+        if text and status == "completed":
+            self._cache_put(key, query, text, emb)
+        return text, True
+
+    async def _stream_run(self, thread_id: str, assistant_id: str):
+        # Stream the run; completion events are pushed to us instead of polled
+        async with self.client.beta.threads.runs.stream(
+            thread_id=thread_id,
+            assistant_id=assistant_id,
+        ) as stream:
+            await stream.until_done()
+            run = await stream.get_final_run()
+            final = await stream.get_final_messages()
+        return run, final
+
+    async def _run_assistant(
+        self,
+        messages: List[dict],
+        *,
+        thread_id: Optional[str] = None,
+        keep_for: Optional[str] = None,
+    ) -> Tuple[str, str]:
+        # Returns (reply, final run status)
+        # Continue an existing conversation's thread, or start a fresh one
+        created = thread_id is None
+        if thread_id is None:
+            thread_id = (await self.client.beta.threads.create()).id
+            if keep_for is not None:
+                set_openai_thread(keep_for, thread_id)
+        try:
+            # Add user messages to the thread (we expect one user message; support many just in case)
+            for content in self._user_contents(messages):
+                await self.client.beta.threads.messages.create(
+                    thread_id=thread_id,
+                    role="user",
+                    content=content,
+                )
+
+            # Capture the id this run uses; recovery must compare against it, not whatever
+            # another caller may have swapped in since
+            assistant_id = self.assistant_id
+            try:
+                run, final = await self._stream_run(thread_id, assistant_id)
+            except NotFoundError:
+                if not await self._recover_assistant(assistant_id):
+                    raise
+                run, final = await self._stream_run(thread_id, self.assistant_id)
+
+            # Streaming ends on any terminal state; don't mistake a failed run for an empty reply
+            if run.status != "completed":
+                logger.warning(
+                    "Assistant run %s ended with status %s: %s",
+                    run.id,
+                    run.status,
+                    getattr(run, "last_error", None),
+                )
+
+            # First text part of the latest assistant message from the run
+            text = next(
+                (
+                    part.text.value
+                    for msg in reversed(final)
+                    if msg.role == "assistant"
+                    for part in msg.content
+                    if getattr(part, "type", None) == "text"
+                ),
+                "",
+            )
 
-        # Run the sync flow in a worker thread to avoid blocking the event loop
-        return await asyncio.to_thread(run_sync_flow, messages)
-        
+            logger.debug("Assistant reply len=%d: %s", len(text), text)
 
+            return text or "", run.status
+        finally:
+            # Clean up off the reply path so the answer returns immediately
+            if created and keep_for is None:
+                self._spawn(self._delete_thread(thread_id))
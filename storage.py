@@ -1,35 +1,81 @@
 from __future__ import annotations
 
-import json
+import os
+import threading
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # fall back to the stdlib encoder
+    orjson = None
+    import json
 
 
 SETTINGS_PATH = Path(".geniebot.json")
+# Kept apart from the settings so small setters don't rewrite cached replies
+RESPONSE_CACHE_PATH = Path(".geniebot-cache.json")
+
+# Parsed settings keyed by the file's mtime, so repeated reads skip the JSON parse
+_cache: Optional[Tuple[float, Dict[str, Any]]] = None
+_lock = threading.Lock()
 
 
 def _read_json(path: Path) -> Dict[str, Any]:
     try:
-        if path.exists():
-            return json.loads(path.read_text(encoding="utf-8"))
+        raw = path.read_bytes()
+        data = orjson.loads(raw) if orjson is not None else json.loads(raw.decode("utf-8"))
+        if isinstance(data, dict):
+            return data
     except Exception:
         pass
     return {}
 
 
 def _write_json(path: Path, data: Dict[str, Any]) -> None:
+    # Write to a sibling temp file and swap it in so readers never see a partial file
+    tmp = path.with_suffix(".tmp")
     try:
-        path.write_text(json.dumps(data, indent=2, ensure_ascii=False), encoding="utf-8")
+        if orjson is not None:
+            payload = orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+        else:
+            payload = json.dumps(data, indent=2, ensure_ascii=False).encode("utf-8")
+        tmp.write_bytes(payload)
+        os.replace(tmp, path)
     except Exception as e:
         raise RuntimeError(f"Failed to write settings: {e}")
 
 
 def load_settings() -> Dict[str, Any]:
-    return _read_json(SETTINGS_PATH)
+    global _cache
+    with _lock:
+        try:
+            mtime = SETTINGS_PATH.stat().st_mtime
+        except OSError:
+            _cache = None
+            return {}
+        if _cache is None or _cache[0] != mtime:
+            _cache = (mtime, _read_json(SETTINGS_PATH))
+        # Shallow copy so callers can mutate before save_settings() without touching the cache
+        return dict(_cache[1])
 
 
 def save_settings(data: Dict[str, Any]) -> None:
-    _write_json(SETTINGS_PATH, data)
+    global _cache
+    with _lock:
+        _write_json(SETTINGS_PATH, data)
+        try:
+            _cache = (SETTINGS_PATH.stat().st_mtime, dict(data))
+        except OSError:
+            _cache = None
+
+
+def load_response_cache() -> Dict[str, Any]:
+    return _read_json(RESPONSE_CACHE_PATH)
+
+
+def save_response_cache(data: Dict[str, Any]) -> None:
+    _write_json(RESPONSE_CACHE_PATH, data)
 
 
 def get_genie_channel_id() -> Optional[int]:
@@ -42,3 +88,58 @@ def set_genie_channel_id(channel_id: int) -> None:
     data = load_settings()
     data["genie_channel_id"] = int(channel_id)
     save_settings(data)
+
+
+def get_command_hashes() -> Dict[str, str]:
+    hashes = load_settings().get("command_hashes")
+    return dict(hashes) if isinstance(hashes, dict) else {}
+
+
+def set_command_hash(scope: str, cmd_hash: str) -> None:
+    # scope is a guild id, or "global" for the application-wide command set
+    data = load_settings()
+    hashes = dict(data.get("command_hashes") or {})
+    hashes[scope] = cmd_hash
+    data["command_hashes"] = hashes
+    save_settings(data)
+
+
+def delete_command_hash(scope: str) -> None:
+    data = load_settings()
+    hashes = dict(data.get("command_hashes") or {})
+    if hashes.pop(scope, None) is None:
+        return
+    data["command_hashes"] = hashes
+    save_settings(data)
+
+
+def get_openai_threads() -> Dict[str, str]:
+    threads = load_settings().get("openai_threads")
+    return dict(threads) if isinstance(threads, dict) else {}
+
+
+def get_openai_thread(discord_thread_id: str) -> Optional[str]:
+    threads = load_settings().get("openai_threads")
+    if not isinstance(threads, dict):
+        return None
+    val = threads.get(str(discord_thread_id))
+    return val if isinstance(val, str) and val else None
+
+
+def set_openai_thread(discord_thread_id: str, openai_thread_id: str) -> None:
+    data = load_settings()
+    threads = dict(data.get("openai_threads") or {})
+    threads[str(discord_thread_id)] = openai_thread_id
+    data["openai_threads"] = threads
+    save_settings(data)
+
+
+def delete_openai_thread(discord_thread_id: str) -> Optional[str]:
+    data = load_settings()
+    threads = dict(data.get("openai_threads") or {})
+    val = threads.pop(str(discord_thread_id), None)
+    if val is None:
+        return None
+    data["openai_threads"] = threads
+    save_settings(data)
+    return val